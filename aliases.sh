@@ -10,5 +10,6 @@ function dev.run.server() {
 function dev.run.setup() {
     wget -qO- "https://github.com/rippinrobr/baseball-stats-db/releases/download/2018.02/baseballdatabank-2019-02-18-sqlite.tgz" | tar xvz
     cat baseballdatabank-2019-02-18-sqlite.sql | sqlite3 database.sqlite
+    python -m src.precompute
     echo "Done"
 }
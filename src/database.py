@@ -49,5 +49,8 @@ class Database:
         cur.close()
         return rows
 
+    def commit(self):
+        self._conn.commit()
+
     def close(self):
         self._conn.close()
@@ -0,0 +1,62 @@
+"""
+Encodes models as the dictionaries and documents served by the server.
+"""
+import json
+
+
+def encode_profile(profile):
+    """
+    Returns a dict representing the given profile.
+
+    Arguments:
+        profile: An instance of models.Profile
+    """
+    if profile is None:
+        return None
+
+    return {"name": profile.name, "country": profile.country, "year": profile.year}
+
+
+def encode_stats(stats):
+    """
+    Returns a dict representing the given player stats.
+
+    Arguments:
+        profile: An instance of models.Stats
+    """
+    if stats is None:
+        return None
+
+    return {
+        "atBats": stats.at_bats,
+        "homeRuns": stats.home_runs,
+        "hits": stats.hits,
+        "strikeouts": stats.strikeouts,
+        "battingAverage": round(stats.batting_average, 3),
+        "sluggingPercentage": round(stats.slugging_percentage, 3),
+    }
+
+
+def encode_document(profile, stats):
+    """
+    Returns a serialized document representing the given player.
+
+    Arguments:
+        profile:    An instance of models.Profile
+        stats:      An instance of models.Stats
+    """
+    document = {"profile": encode_profile(profile), "stats": encode_stats(stats)}
+    return json.dumps(document, separators=(",", ":")).encode()
+
+
+def decode_document(document):
+    """
+    Returns a dict from a serialized player document.
+
+    Arguments:
+        document:   Bytes created by encode_document, or None.
+    """
+    if document is None:
+        return None
+
+    return json.loads(document)
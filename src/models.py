@@ -1,9 +1,18 @@
 """
 Data models.
 """
+import bisect
+import collections
 import dataclasses
+import heapq
+import pathlib
+import sys
 
 from . import database
+from . import encoding
+
+# Location of the database served by the server
+DATABASE_PATH = pathlib.Path(__file__).parent.parent / "database.sqlite"
 
 KNOWN_POSITIONS = {
     "pitcher",
@@ -49,6 +58,10 @@ class Stats:
 
     @classmethod
     def from_parts(cls, at_bats, hits, doubles, triples, home_runs, strikeouts):
+        if not at_bats:
+            # Players such as pitchers may never have batted
+            return cls(*([0] * 6))
+
         batting_average = hits / at_bats
         singles = hits - doubles - triples - home_runs
         slugging = (singles + (2 * doubles) + (3 * triples) + (4 * home_runs)) / at_bats
@@ -129,27 +142,247 @@ def get_db(path):
     """
     db.execute(query)
 
+    query = """
+    CREATE TABLE IF NOT EXISTS "PlayerKeys" (
+    	"playerKey" INTEGER PRIMARY KEY,
+        "playerID" TEXT UNIQUE
+    );
+    """
+    db.execute(query)
+
+    query = """
+    CREATE TABLE IF NOT EXISTS "BattingTotals" (
+    	"playerKey" INTEGER PRIMARY KEY,
+        "AB" INTEGER,
+        "_2B" INTEGER,
+        "_3B" INTEGER,
+        "HR" INTEGER,
+        "H" INTEGER,
+        "SO" INTEGER
+    );
+    """
+    db.execute(query)
+
+    query = """
+    CREATE TABLE IF NOT EXISTS "DerivedSources" (
+    	"name" TEXT PRIMARY KEY,
+        "rows" INTEGER,
+        "maxRowid" INTEGER
+    );
+    """
+    db.execute(query)
+
     query = """
     CREATE TABLE IF NOT EXISTS "Lineups" (
-    	"lineupId" INTEGER PRIMARY KEY AUTOINCREMENT
+    	"lineupId" INTEGER PRIMARY KEY AUTOINCREMENT,
+        "version" INTEGER DEFAULT 0
     );
     """
     db.execute(query)
 
+    # Databases created before lineups were versioned
+    if "version" not in get_columns(db, "Lineups"):
+        db.execute('ALTER TABLE "Lineups" ADD COLUMN "version" INTEGER DEFAULT 0')
+
+    # Databases created before players had integer keys
+    migrate_assignments = "playerId" in get_columns(db, "LineupAssignments")
+    if migrate_assignments:
+        query = 'ALTER TABLE "LineupAssignments" RENAME TO "LineupAssignmentsText"'
+        db.execute(query)
+
+    if "playerID" in get_columns(db, "PlayerDocuments"):
+        # Documents are regenerated by precompute
+        db.execute('DROP TABLE "PlayerDocuments"')
+
     query = """
     CREATE TABLE IF NOT EXISTS "LineupAssignments" (
     	"lineupId" INTEGER,
         "position" TEXT,
-        "playerId" TEXT,
+        "playerKey" INTEGER,
         UNIQUE("lineupId", "position"),
-        UNIQUE("lineupId", "playerId")
+        UNIQUE("lineupId", "playerKey")
+    );
+    """
+    db.execute(query)
+
+    query = """
+    CREATE TABLE IF NOT EXISTS "PlayerDocuments" (
+    	"playerKey" INTEGER PRIMARY KEY,
+        "document" BLOB
     );
     """
     db.execute(query)
 
+    if migrate_assignments:
+        build_player_keys(db)
+        query = """
+            INSERT INTO LineupAssignments
+            SELECT lineupId,position,playerKey
+            FROM LineupAssignmentsText
+            LEFT JOIN PlayerKeys
+            ON LineupAssignmentsText.playerId = PlayerKeys.playerID
+        """
+        db.execute(query)
+        db.execute('DROP TABLE "LineupAssignmentsText"')
+        db.commit()
+
     return db
 
 
+def get_columns(db, table):
+    """
+    Fetch the column names of a table.
+
+    Arguments:
+        db:     An instance of databases.Database.
+        table:  A table name.
+
+    Returns:
+        A list of string column names, empty if the table does not exist.
+    """
+    query = f'PRAGMA table_info("{table}")'
+    return [column for _, column, *_ in db.fetchall(query, [])]
+
+
+def build_player_keys(db):
+    """
+    Assigns an integer key to every player without one. Existing keys never change.
+
+    Arguments:
+        db:     An instance of databases.Database.
+    """
+    query = """
+        INSERT OR IGNORE INTO PlayerKeys (playerID)
+        SELECT playerID FROM People ORDER BY playerID
+    """
+    db.execute(query)
+    db.commit()
+
+
+def get_derived_sources(db):
+    """
+    Fetch the row count and largest rowid of the tables derived tables are built
+    from, which change whenever the data is reloaded.
+
+    Arguments:
+        db:     An instance of databases.Database.
+
+    Returns:
+        A list of (table name, row count, largest rowid) tuples.
+    """
+    sources = []
+    for table in ("People", "Batting"):
+        query = f'SELECT COUNT(*), MAX(rowid) FROM "{table}"'
+        sources.append((table, *db.fetchone(query, [])))
+
+    return sources
+
+
+def build_documents(db, batch_size=500):
+    """
+    Yields a serialized document for every player.
+
+    Arguments:
+        db:         An instance of databases.Database.
+        batch_size: (optional) Number of players fetched per query.
+    """
+    player_keys = PlayerKeys.load(db)
+    idents = player_keys.idents()
+    for start in range(0, len(idents), batch_size):
+        batch = idents[start : start + batch_size]
+        keys = [player_keys.key(ident) for ident in batch]
+        profiles = get_profiles(db, batch)
+        all_stats = get_stats_by_keys(db, keys)
+        for key, profile, stats in zip(keys, profiles, all_stats):
+            yield key, encoding.encode_document(profile, stats)
+
+
+def build_derived_tables(db):
+    """
+    Rebuilds tables derived from People and Batting, including player documents.
+    Must be run after the data is (re)loaded.
+
+    Arguments:
+        db:     An instance of databases.Database.
+    """
+    build_player_keys(db)
+
+    db.execute("DELETE FROM BattingTotals")
+    query = """
+        INSERT INTO BattingTotals
+        SELECT playerKey, SUM(AB), SUM(_2B), SUM(_3B), SUM(HR), SUM(H), SUM(SO)
+        FROM Batting
+        INNER JOIN PlayerKeys
+        ON Batting.playerID = PlayerKeys.playerID
+        GROUP BY playerKey
+    """
+    db.execute(query)
+    set_documents(db, list(build_documents(db)))
+
+    db.execute("DELETE FROM DerivedSources")
+    db.insert("INSERT INTO DerivedSources VALUES(?, ?, ?)", get_derived_sources(db))
+
+
+def ensure_derived_tables(db):
+    """
+    Rebuilds tables derived from People and Batting if the data was (re)loaded
+    since they were last built.
+
+    Arguments:
+        db:     An instance of databases.Database.
+    """
+    query = "SELECT name, rows, maxRowid FROM DerivedSources ORDER BY name"
+    built = [tuple(row) for row in db.fetchall(query, [])]
+    if built != sorted(get_derived_sources(db)):
+        build_derived_tables(db)
+
+
+class PlayerKeys:
+    """
+    Interned, bidirectional map of string player identifiers and integer keys.
+    """
+
+    def __init__(self, rows):
+        """
+        Arguments:
+            rows:   An iterable of (integer key, string player identifier) tuples.
+        """
+        self._keys = {}
+        self._idents = {}
+        for key, ident in rows:
+            ident = sys.intern(ident)
+            self._keys[ident] = key
+            self._idents[key] = ident
+
+    @classmethod
+    def load(cls, db):
+        """
+        Loads every player key.
+
+        Arguments:
+            db:     An instance of databases.Database.
+        """
+        return cls(db.fetchall("SELECT playerKey, playerID FROM PlayerKeys", []))
+
+    def key(self, ident):
+        """
+        Returns the integer key of a string player identifier, or None if unknown.
+        """
+        return self._keys.get(ident)
+
+    def ident(self, key):
+        """
+        Returns the string player identifier of an integer key, or None if unknown.
+        """
+        return self._idents.get(key)
+
+    def idents(self):
+        """
+        Returns a list of all string player identifiers.
+        """
+        return list(self._keys)
+
+
 def get_players(db, first_name, last_name):
     """
     Query for players whose first and last name start with the given prefixes,
@@ -178,6 +411,61 @@ def get_players(db, first_name, last_name):
     return output
 
 
+def get_player_details(db, first_name, last_name, stats=True):
+    """
+    Query for players whose first and last name start with the given prefixes,
+    respectively, along with their profiles and optionally their stats.
+
+    Arguments:
+        db:         An instance of databases.Database.
+        first_name: A string prefix for the first name.
+        last_name:  A string prefix for the last name.
+        stats:      (optional) If False, stats are not aggregated.
+
+    Returns:
+        A list of (string player identifier, Profile, Stats) tuples. Stats are None
+        if not requested.
+    """
+    if stats:
+        query = """
+            SELECT
+            People.playerId,namefirst,namelast,birthCountry,birthYear,
+            AB, _2B, _3B, HR, H, SO
+            FROM People
+            LEFT JOIN PlayerKeys
+            ON People.playerId = PlayerKeys.playerID
+            LEFT JOIN BattingTotals
+            ON PlayerKeys.playerKey = BattingTotals.playerKey
+            WHERE namefirst LIKE ? and namelast LIKE ?
+            ORDER BY namefirst,namelast
+        """
+    else:
+        query = """
+            SELECT
+            playerId,namefirst,namelast,birthCountry,birthYear
+            FROM People
+            WHERE namefirst LIKE ? and namelast LIKE ?
+            ORDER BY namefirst,namelast
+        """
+
+    output = []
+    for result in db.fetchall(query, [f"{first_name}%", f"{last_name}%"]):
+        ident, first, last, country, year, *totals = result
+        profile = Profile.from_parts(first, last, country, year)
+
+        if not stats:
+            player_stats = None
+        elif totals[0] is None:
+            player_stats = Stats(*([0] * 6))
+        else:
+            ab, dbl, tpl, hr, h, so = totals
+            player_stats = Stats.from_parts(ab, h, dbl, tpl, hr, so)
+
+        output.append((ident, profile, player_stats))
+
+    return output
+
+
 def get_profiles(db, idents):
     """
     Fetch player profiles.
@@ -225,10 +513,11 @@ def get_stats(db, idents):
     placeholders = ",".join(["?"] * len(idents))
     query = (
         "SELECT"
-        " playerId, SUM(AB), SUM(_2B), SUM(_3B), SUM(HR), SUM(H), SUM(SO)"
-        " FROM Batting"
-        f" WHERE playerId IN ({placeholders})"
-        " GROUP BY playerId"
+        " playerID, AB, _2B, _3B, HR, H, SO"
+        " FROM PlayerKeys"
+        " INNER JOIN BattingTotals"
+        " ON PlayerKeys.playerKey = BattingTotals.playerKey"
+        f" WHERE playerID IN ({placeholders})"
     )
 
     mapping = {}
@@ -246,6 +535,97 @@ def get_stats(db, idents):
     return output
 
 
+def get_stats_by_keys(db, keys):
+    """
+    Fetch player performance statistics.
+
+    Arguments:
+        db:     An instance of databases.Database.
+        keys:   A list of integer player keys. Unknown players may be None.
+
+    Returns:
+        A list of Stats objects.
+    """
+    placeholders = ",".join(["?"] * len(keys))
+    query = (
+        "SELECT"
+        " playerKey, AB, _2B, _3B, HR, H, SO"
+        " FROM BattingTotals"
+        f" WHERE playerKey IN ({placeholders})"
+    )
+
+    mapping = {}
+    for result in db.fetchall(query, keys):
+        key, ab, dbl, tpl, hr, h, so = result
+        mapping[key] = Stats.from_parts(ab, h, dbl, tpl, hr, so)
+
+    output = []
+    for key in keys:
+        try:
+            output.append(mapping[key])
+        except KeyError:
+            output.append(Stats(*([0] * 6)))
+
+    return output
+
+
+def get_documents(db, keys):
+    """
+    Fetch precomputed player documents.
+
+    Arguments:
+        db:     An instance of databases.Database.
+        keys:   A list of integer player keys. Unknown players may be None.
+
+    Returns:
+        A list of serialized documents, or None for players without one.
+    """
+    placeholders = ",".join(["?"] * len(keys))
+    query = (
+        "SELECT playerKey, document"
+        " FROM PlayerDocuments"
+        f" WHERE playerKey IN ({placeholders})"
+    )
+    mapping = dict(db.fetchall(query, keys))
+    return [mapping.get(key) for key in keys]
+
+
+def set_documents(db, documents):
+    """
+    Replaces all precomputed player documents.
+
+    Arguments:
+        db:         An instance of databases.Database.
+        documents:  An iterable of (integer player key, serialized document).
+    """
+    db.execute("DELETE FROM PlayerDocuments")
+    db.insert("INSERT INTO PlayerDocuments VALUES(?, ?)", documents)
+
+
+def get_all_stats(db, min_at_bats=0):
+    """
+    Fetch performance statistics of every player with enough at bats.
+
+    Arguments:
+        db:             An instance of databases.Database.
+        min_at_bats:    (optional) Players with fewer career at bats are excluded.
+
+    Returns:
+        A list of Stats objects.
+    """
+    query = """
+        SELECT AB, _2B, _3B, HR, H, SO
+        FROM BattingTotals
+        WHERE AB >= ? AND AB > 0
+    """
+    output = []
+    for result in db.fetchall(query, [min_at_bats]):
+        ab, dbl, tpl, hr, h, so = result
+        output.append(Stats.from_parts(ab, h, dbl, tpl, hr, so))
+
+    return output
+
+
 def get_lineup(db, ident):
     """
     Fetch players in a lineup.
@@ -258,10 +638,12 @@ def get_lineup(db, ident):
         A Lineup object.
     """
     query = """
-        SELECT position,playerId
+        SELECT position,playerID
         FROM Lineups
         INNER JOIN LineupAssignments
         ON Lineups.lineupId = LineupAssignments.lineupId
+        LEFT JOIN PlayerKeys
+        ON LineupAssignments.playerKey = PlayerKeys.playerKey
         WHERE Lineups.lineupId=?
     """
     positions = dict((position, None) for position in KNOWN_POSITIONS)
@@ -269,6 +651,118 @@ def get_lineup(db, ident):
     return Lineup(ident, **(positions | assignments))
 
 
+def get_lineup_details(db, ident):
+    """
+    Fetch players in a lineup along with their profiles and the lineup version.
+
+    Arguments:
+        db:     An instance of databases.Database.
+        ident:  An integer lineup identifier.
+
+    Returns:
+        A tuple of a Lineup object, a dictionary of string player identifier keys
+        and Profile values, and the integer version of the lineup. The version is
+        None if the lineup does not exist.
+    """
+    query = """
+        SELECT Lineups.lineupId,version,position,PlayerKeys.playerID,
+        namefirst,namelast,birthCountry,birthYear
+        FROM Lineups
+        LEFT JOIN LineupAssignments
+        ON Lineups.lineupId = LineupAssignments.lineupId
+        LEFT JOIN PlayerKeys
+        ON LineupAssignments.playerKey = PlayerKeys.playerKey
+        LEFT JOIN People
+        ON PlayerKeys.playerID = People.playerId
+        WHERE Lineups.lineupId=?
+    """
+    details = collect_lineup_details(db.fetchall(query, [ident]))
+    try:
+        return details[0]
+    except IndexError:
+        positions = dict((position, None) for position in KNOWN_POSITIONS)
+        return Lineup(ident, **positions), {}, None
+
+
+def get_recent_lineup_details(db, limit):
+    """
+    Fetch the most recently created lineups along with their profiles and versions.
+
+    Arguments:
+        db:     An instance of databases.Database.
+        limit:  The maximum number of lineups to fetch.
+
+    Returns:
+        A list of tuples as returned by get_lineup_details.
+    """
+    query = """
+        SELECT Lineups.lineupId,version,position,PlayerKeys.playerID,
+        namefirst,namelast,birthCountry,birthYear
+        FROM Lineups
+        LEFT JOIN LineupAssignments
+        ON Lineups.lineupId = LineupAssignments.lineupId
+        LEFT JOIN PlayerKeys
+        ON LineupAssignments.playerKey = PlayerKeys.playerKey
+        LEFT JOIN People
+        ON PlayerKeys.playerID = People.playerId
+        WHERE Lineups.lineupId IN (
+            SELECT lineupId FROM Lineups ORDER BY lineupId DESC LIMIT ?
+        )
+    """
+    return collect_lineup_details(db.fetchall(query, [limit]))
+
+
+def collect_lineup_details(rows):
+    """
+    Helper to group joined lineup rows by lineup.
+
+    Arguments:
+        rows:   A list of rows as selected by get_lineup_details.
+
+    Returns:
+        A list of tuples as returned by get_lineup_details.
+    """
+    versions = {}
+    assignments = collections.defaultdict(dict)
+    profiles = collections.defaultdict(dict)
+    for result in rows:
+        ident, version, position, player_id, first, last, country, year = result
+        versions[ident] = version
+        if position is None:
+            continue
+
+        assignments[ident][position] = player_id
+        if player_id is not None:
+            profiles[ident][player_id] = Profile.from_parts(first, last, country, year)
+
+    output = []
+    for ident, version in versions.items():
+        positions = dict((position, None) for position in KNOWN_POSITIONS)
+        lineup = Lineup(ident, **(positions | assignments[ident]))
+        output.append((lineup, profiles[ident], version))
+
+    return output
+
+
+def get_lineup_version(db, ident):
+    """
+    Fetch the version of a lineup, which is incremented by every update.
+
+    Arguments:
+        db:     An instance of databases.Database.
+        ident:  An integer lineup identifier.
+
+    Returns:
+        An integer version, or None if the lineup does not exist.
+    """
+    row = db.fetchone("SELECT version FROM Lineups WHERE lineupId=?", [ident])
+    if row is None:
+        return None
+
+    (version,) = row
+    return version
+
+
 def create_lineup(db):
     """
     Creates a new lineup.
@@ -279,15 +773,78 @@ def create_lineup(db):
     Returns:
         A Lineup object.
     """
-    query = "INSERT INTO Lineups VALUES(null)"
+    query = "INSERT INTO Lineups DEFAULT VALUES"
     ident = db.insertone(query)
-    return get_lineup(db, ident)
+
+    # A new lineup has no assignments, no need to read it back
+    positions = dict((position, None) for position in KNOWN_POSITIONS)
+    return Lineup(ident, **positions)
 
 
 def update_lineup(db, ident, **kwargs):
     """
     Updates a lineup.
 
+    Arguments:
+        db:     An instance of databases.Database.
+        ident:  An integer lineup identifier.
+        kwargs: (optional) See assign_players.
+
+    Returns:
+        An updated Lineup object.
+    """
+    assign_players(db, ident, **kwargs)
+    return get_lineup(db, ident)
+
+
+def match_player(db, query):
+    """
+    Finds the player matching a string player identifier or name.
+
+    Arguments:
+        db:     An instance of databases.Database.
+        query:  A string player identifier, or a first name optionally followed by a
+                last name. Names match by prefix, ex. "Mike Tr".
+
+    Returns:
+        A tuple of the integer player key, the string player identifier and a
+        Profile, or None if no player matches.
+    """
+    if query is None:
+        return None
+
+    # Allow ident or name combo
+    try:
+        first_name, last_name = query.split(" ", maxsplit=1)
+    except ValueError:
+        first_name = query
+        last_name = ""
+
+    sql = """
+        SELECT
+        playerKey,People.playerId,namefirst,namelast,birthCountry,birthYear
+        FROM People
+        INNER JOIN PlayerKeys
+        ON People.playerId = PlayerKeys.playerID
+        WHERE People.playerId=?
+            OR (
+                namefirst LIKE ?
+                AND namelast LIKE ?
+            )
+        LIMIT 1
+    """
+    result = db.fetchone(sql, [query, f"{first_name}%", f"{last_name}%"])
+    if result is None:
+        return None
+
+    key, ident, first, last, country, year = result
+    return key, ident, Profile.from_parts(first, last, country, year)
+
+
+def assign_players(db, ident, **kwargs):
+    """
+    Assigns players to positions in a lineup without reading it back.
+
     Arguments:
         db:     An instance of databases.Database.
         ident:  An integer lineup identifier.
@@ -296,41 +853,243 @@ def update_lineup(db, ident, **kwargs):
                 If no key is defined for a given position it will be left unchanged.
 
     Returns:
-        An updated Lineup object.
+        A dictionary of the assigned position keys and tuples as returned by
+        match_player, or None if no player matched.
     """
-    data = []
+    players = {}
     for position, query in kwargs.items():
         if position not in KNOWN_POSITIONS:
             continue
 
-        # Allow ident or name combo
-        player_id = query
-        try:
-            first_name, last_name = query.split(" ", maxsplit=1)
-        except ValueError:
-            first_name = query
-            last_name = ""
+        players[position] = match_player(db, query)
 
-        data.append([ident, position, player_id, f"{first_name}%", f"{last_name}%"])
+    db.execute("UPDATE Lineups SET version = version + 1 WHERE lineupId=?", [ident])
 
-    query = """
-        INSERT OR REPLACE INTO LineupAssignments
-        VALUES(
-            ?,
-            ?,
-            (
-                SELECT playerId
-                FROM People
-                WHERE playerId=?
-                    OR (
-                        namefirst LIKE ?
-                        AND namelast LIKE ?
-                    )
-                LIMIT 1
-            )
+    # A player assigned to another position of the lineup is replaced there
+    data = []
+    for position, player in players.items():
+        key = None if player is None else player[0]
+        data.append([ident, position, key])
+
+    db.insert("INSERT OR REPLACE INTO LineupAssignments VALUES(?, ?, ?)", data)
+    return players
+
+
+class League:
+    """
+    Ranks values against all qualified players using sorted arrays per metric.
+    """
+
+    def __init__(self, rows, metrics):
+        """
+        Arguments:
+            rows:       A list of dictionaries of metric keys and numeric values.
+            metrics:    The keys to rank on.
+        """
+        self._values = dict(
+            (metric, sorted(row[metric] for row in rows)) for metric in metrics
         )
+
+    def percentile(self, metric, value):
+        """
+        Returns the percentage of qualified players whose value for the given metric
+        is at most the given value, or 0 if there are no qualified players.
+
+        Arguments:
+            metric: A metric key.
+            value:  A numeric value to rank.
+        """
+        values = self._values[metric]
+        if not values:
+            return 0
+
+        return 100 * bisect.bisect_right(values, value) / len(values)
+
+
+class LineupCache:
     """
+    Bounded, write-through in-memory cache of lineups.
 
-    db.insert(query, data)
+    Lineups created or updated through the cache are stored without being read again.
+    Entries are tagged with the lineup version, which is checked against the
+    database whenever another connection, such as another worker, has committed
+    changes since the entry was last used.
+    """
 
-    return get_lineup(db, ident)
+    def __init__(self, db, maxsize=1024):
+        self._db = db
+        self._maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._verified = set()
+        self._data_version = None
+
+    def warm(self):
+        """
+        Loads the most recently created lineups, up to the size of the cache.
+        """
+        self._check_data_version()
+        for lineup, profiles, version in get_recent_lineup_details(
+            self._db, self._maxsize
+        ):
+            self._put(lineup, profiles, version)
+
+    def get(self, ident):
+        """
+        Fetch a lineup.
+
+        Arguments:
+            ident:  An integer lineup identifier.
+
+        Returns:
+            A tuple of a Lineup object and a dictionary of string player identifier
+            keys and Profile values.
+        """
+        self._check_data_version()
+
+        entry = self._lookup(ident)
+        if entry is None:
+            entry = get_lineup_details(self._db, ident)
+            lineup, profiles, version = entry
+            if version is None:
+                # Do not cache lineups which do not exist
+                return lineup, profiles
+
+            self._put(lineup, profiles, version)
+
+        self._entries.move_to_end(ident)
+        lineup, profiles, _ = entry
+        return lineup, profiles
+
+    def create(self):
+        """
+        Creates a new lineup.
+
+        Returns:
+            A Lineup object.
+        """
+        self._check_data_version()
+        lineup = create_lineup(self._db)
+        self._put(lineup, {}, 0)
+        return lineup
+
+    def update(self, ident, **kwargs):
+        """
+        Updates a lineup.
+
+        Arguments:
+            ident:  An integer lineup identifier.
+            kwargs: (optional) See assign_players.
+
+        Returns:
+            A tuple as returned by get, followed by the integer version of the
+            lineup, or None if it does not exist.
+        """
+        self._check_data_version()
+
+        entry = self._lookup(ident)
+        players = assign_players(self._db, ident, **kwargs)
+        if entry is None:
+            # Not cached, read the lineup back
+            lineup, profiles, version = get_lineup_details(self._db, ident)
+        else:
+            lineup, profiles, version = self._assign(entry, players)
+
+        if version is not None:
+            self._put(lineup, profiles, version)
+
+        return lineup, profiles, version
+
+    def _lookup(self, ident):
+        # Returns the cached entry if it is up to date, otherwise None
+        entry = self._entries.get(ident)
+        if entry is not None and ident not in self._verified:
+            _, _, version = entry
+            if get_lineup_version(self._db, ident) != version:
+                return None
+
+            self._verified.add(ident)
+
+        return entry
+
+    @staticmethod
+    def _assign(entry, players):
+        # Applies the assignments of assign_players to a cached entry
+        lineup, profiles, version = entry
+        assignments = dict(
+            (position, getattr(lineup, position)) for position in KNOWN_POSITIONS
+        )
+        profiles = dict(profiles)
+        for position, player in players.items():
+            if player is None:
+                assignments[position] = None
+                continue
+
+            _, player_id, profile = player
+            for other, assigned in assignments.items():
+                if assigned == player_id:
+                    assignments[other] = None
+
+            assignments[position] = player_id
+            profiles[player_id] = profile
+
+        profiles = dict(
+            (player_id, profiles[player_id])
+            for player_id in assignments.values()
+            if player_id is not None
+        )
+        return Lineup(lineup.ident, **assignments), profiles, version + 1
+
+    def _put(self, lineup, profiles, version):
+        self._entries[lineup.ident] = (lineup, profiles, version)
+        self._entries.move_to_end(lineup.ident)
+        self._verified.add(lineup.ident)
+
+        while len(self._entries) > self._maxsize:
+            ident, _ = self._entries.popitem(last=False)
+            self._verified.discard(ident)
+
+    def _check_data_version(self):
+        # Only changes committed by other connections alter the data version
+        (data_version,) = self._db.fetchone("PRAGMA data_version", [])
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._verified.clear()
+
+
+def optimize_lineup(locked, candidates, objective, min_at_bats=0):
+    """
+    Builds the lineup maximizing the average of an objective stat.
+
+    Lineup averages are the mean of each player's stats and any player may fill any
+    position, so the best lineup is made of the highest scoring candidates.
+
+    Arguments:
+        locked:      A dictionary of position keys and string player identifier
+                     values which must be kept, ex. {"pitcher": "foo"}.
+        candidates:  A dictionary of string player identifier keys and Stats values.
+        objective:   The name of the Stats attribute to maximize, ex.
+                     "batting_average".
+        min_at_bats: (optional) Candidates with fewer at bats are not considered.
+
+    Returns:
+        A Lineup object without an identifier.
+    """
+    assignments = dict((position, None) for position in KNOWN_POSITIONS)
+    for position, ident in locked.items():
+        if position in KNOWN_POSITIONS and ident is not None:
+            assignments[position] = ident
+
+    taken = set(assignments.values())
+    open_positions = sorted(p for p, ident in assignments.items() if ident is None)
+
+    eligible = [
+        (getattr(stats, objective), ident)
+        for ident, stats in candidates.items()
+        if ident not in taken and stats.at_bats > 0 and stats.at_bats >= min_at_bats
+    ]
+    best = heapq.nlargest(len(open_positions), eligible)
+
+    for position, (_, ident) in zip(open_positions, best):
+        assignments[position] = ident
+
+    return Lineup(None, **assignments)
@@ -0,0 +1,22 @@
+"""
+Precomputes derived tables and serialized player documents served by the server.
+
+Run after (re)loading the database with: `python -m src.precompute`
+"""
+from . import models
+
+
+def precompute(db):
+    """
+    Rebuilds derived tables and replaces all player documents with freshly
+    computed ones.
+
+    Arguments:
+        db:     An instance of databases.Database.
+    """
+    models.build_derived_tables(db)
+
+
+if __name__ == "__main__":
+    precompute(models.get_db(models.DATABASE_PATH))
+    print("Done")
@@ -0,0 +1,247 @@
+"""
+On-demand sampling profiler for individual requests.
+
+Only samples taken while the profiled request's task, or a task it spawned, is
+running are recorded, so concurrent requests do not appear in its profile.
+"""
+import asyncio
+import collections
+import contextvars
+import hmac
+import os
+import pathlib
+import random
+import sys
+import threading
+import time
+import uuid
+import weakref
+
+# The profiler of the request running in the current context, if any
+current_profiler = contextvars.ContextVar("current_profiler", default=None)
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the stack of a thread from a background thread.
+
+    Everything running on the sampled thread is recorded, which for an event loop
+    includes resolvers, data loader batch functions and database calls. If a loop is
+    given, only samples taken while one of the tasks in the tasks attribute is
+    running on it are recorded.
+    """
+
+    def __init__(self, thread_id, interval=0.001, loop=None):
+        """
+        Arguments:
+            thread_id:  The identifier of the thread to sample.
+            interval:   (optional) Seconds between samples.
+            loop:       (optional) The event loop running on the sampled thread.
+        """
+        self._thread_id = thread_id
+        self._interval = interval
+        self._loop = loop
+        self._stop = threading.Event()
+        self._thread = None
+        self.samples = collections.Counter()
+        self.tasks = weakref.WeakSet()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                break
+
+            if self._loop is not None:
+                task = asyncio.current_task(self._loop)
+                if task is None or task not in self.tasks:
+                    continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+                stack.append(name)
+                frame = frame.f_back
+
+            self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """
+        Returns the samples in the collapsed stack format read by flamegraph tools.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.items())
+
+    def summary(self, limit=20):
+        """
+        Returns a plain text summary of the functions seen most often.
+
+        Arguments:
+            limit:  (optional) The number of functions to list.
+        """
+        total = sum(self.samples.values())
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                inclusive[name] += count
+
+        lines = [f"samples: {total}", "", "own time:"]
+        for name, count in own.most_common(limit):
+            lines.append(f"{100 * count / total:6.1f}%  {name}")
+
+        lines += ["", "total time:"]
+        for name, count in inclusive.most_common(limit):
+            lines.append(f"{100 * count / total:6.1f}%  {name}")
+
+        return "\n".join(lines) + "\n"
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware which profiles selected HTTP requests.
+
+    A request is profiled if it carries the X-Profile header set to the configured
+    token, or at random with the configured sample rate. Each profile is written to
+    the output directory as a collapsed stack file and a text summary.
+    """
+
+    def __init__(self, app, directory, token=None, sample_rate=0.0):
+        """
+        Arguments:
+            app:            The ASGI application to wrap.
+            directory:      Path where profiles are written.
+            token:          (optional) Secret value of the X-Profile header.
+            sample_rate:    (optional) Fraction of requests to profile, from 0 to 1.
+        """
+        self.app = app
+        self.directory = pathlib.Path(directory)
+        self.token = token
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        install_task_factory(loop)
+
+        profiler = SamplingProfiler(threading.get_ident(), loop=loop)
+        profiler.tasks.add(asyncio.current_task())
+        token = current_profiler.set(profiler)
+        started = time.perf_counter()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            current_profiler.reset(token)
+            self.write(profiler, time.perf_counter() - started)
+
+    def should_profile(self, scope):
+        """
+        Returns True if the request should be profiled.
+
+        Arguments:
+            scope:  The ASGI connection scope.
+        """
+        if self.token:
+            for key, value in scope["headers"]:
+                if key == b"x-profile":
+                    return hmac.compare_digest(value, self.token.encode())
+
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def write(self, profiler, elapsed):
+        """
+        Writes a profile to the output directory.
+
+        Arguments:
+            profiler:   A stopped SamplingProfiler.
+            elapsed:    Wall clock seconds spent handling the request.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+        path = self.directory / f"{name}.folded"
+        path.write_text(profiler.collapsed())
+
+        summary = f"elapsed: {elapsed:.3f}s\n" + profiler.summary()
+        (self.directory / f"{name}.txt").write_text(summary)
+
+
+class TaskFactory:
+    """
+    Event loop task factory which adds tasks created while a request is profiled to
+    its profiler, so that work the request spawns is attributed to it.
+    """
+
+    def __init__(self, previous=None):
+        """
+        Arguments:
+            previous:   (optional) The task factory previously set on the loop.
+        """
+        self.previous = previous
+
+    def __call__(self, loop, coro, context=None, **kwargs):
+        if context is not None:
+            kwargs["context"] = context
+
+        if self.previous is None:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        else:
+            task = self.previous(loop, coro, **kwargs)
+
+        # Tasks run in a copy of the context they are created from
+        if context is None:
+            profiler = current_profiler.get()
+        else:
+            profiler = context.get(current_profiler)
+
+        if profiler is not None:
+            profiler.tasks.add(task)
+
+        return task
+
+
+def install_task_factory(loop):
+    """
+    Sets a TaskFactory on the event loop, unless already set.
+
+    Arguments:
+        loop:   An asyncio event loop.
+    """
+    factory = loop.get_task_factory()
+    if not isinstance(factory, TaskFactory):
+        loop.set_task_factory(TaskFactory(factory))
+
+
+def from_environ(app):
+    """
+    Wraps an ASGI application with ProfilingMiddleware if enabled by environment
+    variables, otherwise returns it unchanged.
+
+    Reads BASEBALL_PROFILE_TOKEN, BASEBALL_PROFILE_SAMPLE_RATE and
+    BASEBALL_PROFILE_DIR (defaults to "profiles").
+
+    Arguments:
+        app:    The ASGI application to wrap.
+    """
+    token = os.environ.get("BASEBALL_PROFILE_TOKEN")
+    sample_rate = float(os.environ.get("BASEBALL_PROFILE_SAMPLE_RATE", 0))
+    if not token and sample_rate <= 0:
+        return app
+
+    directory = os.environ.get("BASEBALL_PROFILE_DIR", "profiles")
+    return ProfilingMiddleware(app, directory, token, sample_rate)
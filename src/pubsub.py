@@ -0,0 +1,139 @@
+"""
+In-process publish/subscribe broker for GraphQL subscriptions.
+"""
+import asyncio
+import collections
+
+
+class Subscription:
+    """
+    Async iterator over the events published to a topic.
+
+    Events wait in a bounded queue until the subscriber reads them. Publishing never
+    waits for a slow subscriber: once its queue is full the oldest event is dropped
+    to make room for the newest one.
+    """
+
+    def __init__(self, broker, topic, maxsize):
+        """
+        Arguments:
+            broker:     The Broker this subscription is registered with.
+            topic:      The topic subscribed to.
+            maxsize:    Number of events kept for the subscriber.
+        """
+        self.topic = topic
+        self.dropped = 0
+        self._broker = broker
+        self._queue = asyncio.Queue(maxsize)
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+
+        return await self._queue.get()
+
+    async def aclose(self):
+        """
+        Stops receiving events.
+        """
+        self._closed = True
+        self._broker.unsubscribe(self)
+
+    def put(self, event):
+        """
+        Adds an event to the queue, dropping the oldest event if it is full.
+
+        Arguments:
+            event:  The published event.
+        """
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+
+        self._queue.put_nowait(event)
+
+
+class Broker:
+    """
+    Fans out events to every subscriber of a topic.
+
+    Events are passed to subscribers as they are, so a payload is built once by the
+    publisher however many subscribers receive it. Only subscribers in this process
+    receive events.
+
+    Events may be published with a version, in which case events older than the
+    last one published to the topic are dropped.
+    """
+
+    def __init__(self, maxsize=8):
+        """
+        Arguments:
+            maxsize:    (optional) Number of events kept for each subscriber.
+        """
+        self._maxsize = maxsize
+        self._subscriptions = collections.defaultdict(set)
+        self._versions = {}
+
+    def subscribe(self, topic):
+        """
+        Returns a Subscription receiving events published to a topic from now on.
+
+        Arguments:
+            topic:  A hashable topic, ex. a lineup identifier.
+        """
+        subscription = Subscription(self, topic, self._maxsize)
+        self._subscriptions[topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stops sending events to a subscription.
+
+        Arguments:
+            subscription:   A Subscription returned by subscribe.
+        """
+        subscriptions = self._subscriptions.get(subscription.topic)
+        if subscriptions is None:
+            return
+
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.topic]
+            self._versions.pop(subscription.topic, None)
+
+    def has_subscribers(self, topic):
+        """
+        Returns True if any subscription receives events published to a topic.
+
+        Arguments:
+            topic:  A hashable topic.
+        """
+        return topic in self._subscriptions
+
+    def publish(self, topic, event, version=None):
+        """
+        Sends an event to every subscriber of a topic.
+
+        Arguments:
+            topic:      A hashable topic.
+            event:      Any object, shared by all subscribers.
+            version:    (optional) An increasing integer. The event is dropped if it
+                        is not newer than the last event published to the topic.
+        """
+        subscriptions = self._subscriptions.get(topic)
+        if not subscriptions:
+            return
+
+        if version is not None:
+            latest = self._versions.get(topic)
+            if latest is not None and version <= latest:
+                return
+
+            self._versions[topic] = version
+
+        for subscription in subscriptions:
+            subscription.put(event)
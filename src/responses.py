@@ -0,0 +1,180 @@
+"""
+Fast JSON responses, incremental delivery and response compression.
+"""
+import gzip
+import json
+
+import starlette.datastructures
+import starlette.responses
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def dumps(content):
+    """
+    Returns the given content serialized to compact JSON bytes.
+
+    Uses orjson if installed, falling back to the standard library.
+
+    Arguments:
+        content:    A JSON serializable object.
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+
+    return json.dumps(content, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class FastJSONResponse(starlette.responses.JSONResponse):
+    """
+    JSON response serialized with dumps.
+    """
+
+    def render(self, content):
+        return dumps(content)
+
+
+class MultipartResponse(starlette.responses.StreamingResponse):
+    """
+    Streams GraphQL incremental delivery results as multipart/mixed parts, each
+    sent as soon as it is available.
+    """
+
+    def __init__(self, initial, subsequent):
+        """
+        Arguments:
+            initial:    The JSON serializable initial result.
+            subsequent: An async iterable of JSON serializable subsequent results.
+        """
+        super().__init__(
+            self.iter_parts(initial, subsequent),
+            media_type='multipart/mixed; boundary="-"',
+        )
+
+    @staticmethod
+    async def iter_parts(initial, subsequent):
+        header = b"\r\n---\r\nContent-Type: application/json; charset=utf-8\r\n\r\n"
+        yield header + dumps(initial)
+        async for result in subsequent:
+            yield header + dumps(result)
+        yield b"\r\n-----\r\n"
+
+
+def parse_accept_encoding(header):
+    """
+    Returns the set of content codings accepted by the client.
+
+    Arguments:
+        header: The value of the Accept-Encoding header.
+    """
+    accepted = set()
+    for part in header.split(","):
+        coding, *params = [token.strip() for token in part.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        if coding and quality > 0:
+            accepted.add(coding.lower())
+
+    return accepted
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses with brotli, if installed, or gzip.
+
+    Only complete responses of at least minimum_size bytes are compressed; streamed
+    responses are sent as they are so each part reaches the client immediately.
+    """
+
+    def __init__(self, app, minimum_size=1024, gzip_level=6, brotli_quality=4):
+        """
+        Arguments:
+            app:            The ASGI application to wrap.
+            minimum_size:   (optional) Smaller responses are not compressed.
+            gzip_level:     (optional) Compression level from 1 to 9.
+            brotli_quality: (optional) Compression quality from 0 to 11.
+        """
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = starlette.datastructures.Headers(scope=scope)
+        accepted = parse_accept_encoding(headers.get("accept-encoding", ""))
+        if brotli is not None and "br" in accepted:
+            coding = "br"
+        elif "gzip" in accepted:
+            coding = "gzip"
+        else:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Wait for the body to decide on the headers
+                start = message
+                return
+
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            response_start, start = start, None
+            response_headers = starlette.datastructures.MutableHeaders(
+                raw=response_start["headers"]
+            )
+            body = message.get("body", b"")
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in response_headers
+            ):
+                await send(response_start)
+                await send(message)
+                return
+
+            body = self.compress(coding, body)
+            response_headers["Content-Encoding"] = coding
+            response_headers["Content-Length"] = str(len(body))
+            response_headers.add_vary_header("Accept-Encoding")
+
+            await send(response_start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_compressed)
+
+    def compress(self, coding, body):
+        """
+        Returns the compressed body.
+
+        Arguments:
+            coding: Either "br" or "gzip".
+            body:   Bytes to compress.
+        """
+        if coding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+
+        return gzip.compress(body, compresslevel=self.gzip_level)
@@ -1,25 +1,90 @@
 """
 A GraphQL server build using Ariadne.
 """
-import pathlib
+import asyncio
+import http
+import inspect
 
 import aiodataloader
 import ariadne
 import ariadne.asgi
+import ariadne.asgi.handlers
+import ariadne.exceptions
+import ariadne.logger
+import graphql
+
+# ariadne.graphql is shadowed by the function of the same name
+from ariadne.graphql import (
+    handle_graphql_errors,
+    handle_query_result,
+    parse_query,
+    validate_data,
+    validate_operation_is_not_subscription,
+    validate_query,
+)
 
+from . import encoding
 from . import models
+from . import profiling
+from . import pubsub
+from . import responses
 
 try:
-    db = models.get_db(pathlib.Path(__file__).parent.parent / "database.sqlite")
+    db = models.get_db(models.DATABASE_PATH)
 except FileNotFoundError as exc:
     raise ValueError("The database must be downloaded first, see README.md") from exc
 
+# Loaded once, the server must be restarted after the data is reloaded
+models.ensure_derived_tables(db)
+player_keys = models.PlayerKeys.load(db)
+
+lineup_cache = models.LineupCache(db)
+lineup_cache.warm()
+
+# Lineups published to subscribers whenever they are created or updated
+lineup_events = pubsub.Broker()
+
+# Minimum career at bats for a player to be ranked against
+QUALIFYING_AT_BATS = 1000
+
+STATS_METRICS = [
+    "atBats",
+    "homeRuns",
+    "hits",
+    "strikeouts",
+    "battingAverage",
+    "sluggingPercentage",
+]
+
 type_defs = ariadne.gql(
     """
     type Query {
         player(playerId: String!): Player
         players(firstName: String!, lastName: String!): [Player]!
         lineup(lineupId: Int!): Lineup
+        optimizeLineup(
+            candidatePool: [String!]!,
+            objective: LineupObjective!,
+            lockedPositions: LineupPositions,
+            minAtBats: Int = 0
+        ): Lineup
+    }
+
+    enum LineupObjective {
+        battingAverage
+        sluggingPercentage
+    }
+
+    input LineupPositions {
+        pitcher: String
+        catcher: String
+        firstBase: String
+        secondBase: String
+        thirdBase: String
+        shortstop: String
+        leftField: String
+        centerField: String
+        rightField: String
     }
 
     type Player {
@@ -41,6 +106,16 @@ type_defs = ariadne.gql(
         strikeouts: Int!
         battingAverage: Float!
         sluggingPercentage: Float!
+        percentiles: Percentiles!
+    }
+
+    type Percentiles {
+        atBats: Float!
+        homeRuns: Float!
+        hits: Float!
+        strikeouts: Float!
+        battingAverage: Float!
+        sluggingPercentage: Float!
     }
 
     type Mutation {
@@ -58,6 +133,10 @@ type_defs = ariadne.gql(
         ): Lineup
     }
 
+    type Subscription {
+        lineupChanged(lineupId: Int!): Lineup
+    }
+
     type Lineup {
         lineupId: Int
         average: Stats
@@ -75,17 +154,21 @@ type_defs = ariadne.gql(
 )
 
 
-def encode_profile(profile):
-    """
-    Returns a dict representing the given profile.
-
-    Arguments:
-        profile: An instance of models.Profile
+# Only the schema used for incremental delivery may declare these directives
+incremental_type_defs = ariadne.gql(
     """
-    if profile is None:
-        return None
-
-    return {"name": profile.name, "country": profile.country, "year": profile.year}
+    directive @defer(
+        label: String,
+        if: Boolean! = true
+    ) on FRAGMENT_SPREAD | INLINE_FRAGMENT
+
+    directive @stream(
+        label: String,
+        if: Boolean! = true,
+        initialCount: Int = 0
+    ) on FIELD
+"""
+)
 
 
 def encode_lineup(lineup):
@@ -110,24 +193,109 @@ def encode_lineup(lineup):
     return {"lineupId": lineup.ident} | players
 
 
-def encode_stats(stats):
+async def encode_lineup_event(info, lineup, profiles):
     """
-    Returns a dict representing the given player stats.
+    Returns a dict representing the given lineup, including the profile and stats of
+    each player and the lineup average, so that it is sent to every subscriber
+    without being resolved again.
 
     Arguments:
-        profile: An instance of models.Stats
+        info:       An instance of graphql.GraphQLResolveInfo.
+        lineup:     An instance of models.Lineup
+        profiles:   A dictionary of string player identifiers and models.Profile.
     """
-    if stats is None:
-        return None
+    event = encode_lineup(lineup)
+    players = [event[key] for key in models.KNOWN_POSITIONS if key in event]
 
-    return {
-        "atBats": stats.at_bats,
-        "homeRuns": stats.home_runs,
-        "hits": stats.hits,
-        "strikeouts": stats.strikeouts,
-        "battingAverage": round(stats.batting_average, 3),
-        "sluggingPercentage": round(stats.slugging_percentage, 3),
-    }
+    loader = info.context["player_stats_loader"]
+    all_stats = await loader.load_many([player["playerId"] for player in players])
+    for player, stats in zip(players, all_stats):
+        player["profile"] = encoding.encode_profile(profiles.get(player["playerId"]))
+        player["stats"] = encoding.encode_stats(stats)
+
+    event["average"] = encoding.encode_stats(models.Stats.average(all_stats))
+    return event
+
+
+def iter_fields(info, selection_set):
+    """
+    Yields the field nodes of a selection set, expanding fragments. Deferred
+    fragments are skipped since they are resolved later.
+
+    Arguments:
+        info:           An instance of graphql.GraphQLResolveInfo.
+        selection_set:  A graphql.SelectionSetNode, or None for leaf fields.
+    """
+    if selection_set is None:
+        return
+
+    for selection in selection_set.selections:
+        if any(node.name.value == "defer" for node in selection.directives or []):
+            continue
+
+        if isinstance(selection, graphql.FieldNode):
+            yield selection
+        elif isinstance(selection, graphql.InlineFragmentNode):
+            yield from iter_fields(info, selection.selection_set)
+        elif isinstance(selection, graphql.FragmentSpreadNode):
+            fragment = info.fragments[selection.name.value]
+            yield from iter_fields(info, fragment.selection_set)
+
+
+def is_selected(info, *path):
+    """
+    Returns True if the query selects the given path below the resolved field.
+
+    Arguments:
+        info:   An instance of graphql.GraphQLResolveInfo.
+        path:   Field names relative to the resolved field, ex. "pitcher", "profile".
+    """
+    nodes = getattr(info, "field_nodes", None) or []
+    for name in path:
+        nodes = [
+            field
+            for node in nodes
+            for field in iter_fields(info, node.selection_set)
+            if field.name.value == name
+        ]
+
+    return len(nodes) > 0
+
+
+def prime_lineup_profiles(info, profiles):
+    """
+    Adds the profiles of players in a lineup to the profile loader, if the query
+    selects the profile of any player in the lineup.
+
+    Profiles are not added to the document loader since partial documents would hide
+    the precomputed stats of the players.
+
+    Arguments:
+        info:       An instance of graphql.GraphQLResolveInfo.
+        profiles:   A dictionary of string player identifiers and models.Profile.
+    """
+    if not any(
+        is_selected(info, position, "profile") for position in models.KNOWN_POSITIONS
+    ):
+        return
+
+    loader = info.context["player_profile_loader"]
+    for playerId, profile in profiles.items():
+        loader.prime(playerId, profile)
+
+
+def prime_documents(info, documents):
+    """
+    Adds prefetched player documents to the document loader of the current request.
+
+    Arguments:
+        info:       An instance of graphql.GraphQLResolveInfo.
+        documents:  A dictionary of string player identifiers and player documents,
+                    which may only hold some parts, ex. {"foo": {"profile": {...}}}.
+    """
+    loader = info.context["player_document_loader"]
+    for playerId, document in documents.items():
+        loader.prime(playerId, document)
 
 
 query = ariadne.QueryType()
@@ -153,14 +321,36 @@ def resolve_players(obj, info, firstName, lastName):
 
     Matches players whose first and last names start with the given prefixes.
 
+    If profiles or stats are selected they are fetched along with the players and
+    primed into the loaders.
+
     Arguments:
         obj:        Not used.
-        info:       Not used.
+        info:       Used to look ahead at the selected fields.
         firstName:  A string prefix to match first names against.
         lastName:   A string prefix to mach last names against.
     """
-    idents = models.get_players(db, firstName, lastName)
-    return [{"playerId": ident} for ident in idents]
+    with_profile = is_selected(info, "profile")
+    with_stats = is_selected(info, "stats")
+    if not (with_profile or with_stats):
+        idents = models.get_players(db, firstName, lastName)
+        return [{"playerId": ident} for ident in idents]
+
+    details = models.get_player_details(db, firstName, lastName, stats=with_stats)
+
+    documents = {}
+    for ident, profile, stats in details:
+        documents[ident] = {"profile": encoding.encode_profile(profile)}
+        if with_stats:
+            documents[ident]["stats"] = encoding.encode_stats(stats)
+    prime_documents(info, documents)
+
+    if with_stats:
+        loader = info.context["player_stats_loader"]
+        for ident, _, stats in details:
+            loader.prime(ident, stats)
+
+    return [{"playerId": ident} for ident, _, _ in details]
 
 
 @query.field("lineup")
@@ -170,13 +360,50 @@ def resolve_lineup(obj, info, lineupId):
 
     Arguments:
         obj:        Not used.
-        info:       Not used.
+        info:       Used to look ahead at the selected fields.
         lineupId:   An integer lineup identifier created by this server.
     """
-    lineup = models.get_lineup(db, lineupId)
+    lineup, profiles = lineup_cache.get(lineupId)
+    prime_lineup_profiles(info, profiles)
+    return encode_lineup(lineup)
+
+
+@query.field("optimizeLineup")
+async def resolve_optimize_lineup(
+    obj, info, candidatePool, objective, lockedPositions=None, minAtBats=0
+):
+    """
+    Resolver for the lineup maximizing an objective stat.
+
+    Arguments:
+        obj:                Not used.
+        info:               Not used.
+        candidatePool:      A list of string player identifiers to choose from.
+        objective:          The name of the models.Stats attribute to maximize.
+        lockedPositions:    (optional) A dictionary of position keys and string
+                            player identifier values which must be kept.
+        minAtBats:          (optional) Candidates with fewer at bats are ignored.
+                            None is treated as 0.
+    """
+    loader = info.context["player_stats_loader"]
+    all_stats = await loader.load_many(candidatePool)
+    candidates = dict(zip(candidatePool, all_stats))
+
+    lineup = models.optimize_lineup(
+        lockedPositions or {}, candidates, objective, minAtBats or 0
+    )
     return encode_lineup(lineup)
 
 
+objective = ariadne.EnumType(
+    "LineupObjective",
+    {
+        "battingAverage": "batting_average",
+        "sluggingPercentage": "slugging_percentage",
+    },
+)
+
+
 player = ariadne.ObjectType("Player")
 
 
@@ -189,10 +416,18 @@ async def resolve_player_profile(player, info):
         player:     A dictionary whose key "playerId" maps to a player identifier.
         info:       Not used.
     """
+    if "profile" in player:
+        # Already resolved for lineup subscribers
+        return player["profile"]
+
     playerId = player["playerId"]
+    document = await info.context["player_document_loader"].load(playerId)
+    if document is not None and "profile" in document:
+        return document["profile"]
+
     loader = info.context["player_profile_loader"]
     profile = await loader.load(playerId)
-    return encode_profile(profile)
+    return encoding.encode_profile(profile)
 
 
 @player.field("stats")
@@ -204,10 +439,18 @@ async def resolve_player_stats(player, info):
         player:     A dictionary whose key "playerId" maps to a player identifier.
         info:       Not used.
     """
+    if "stats" in player:
+        # Already resolved for lineup subscribers
+        return player["stats"]
+
     playerId = player["playerId"]
+    document = await info.context["player_document_loader"].load(playerId)
+    if document is not None and "stats" in document:
+        return document["stats"]
+
     loader = info.context["player_stats_loader"]
     stats = await loader.load(playerId)
-    return encode_stats(stats)
+    return encoding.encode_stats(stats)
 
 
 lineup = ariadne.ObjectType("Lineup")
@@ -218,6 +461,10 @@ async def resolve_lineup_average(lineup, info):
     """
     Resolver for summary stats for a lineup.
     """
+    if "average" in lineup:
+        # Already resolved for lineup subscribers
+        return lineup["average"]
+
     loader = info.context["player_stats_loader"]
 
     all_stats = []
@@ -231,15 +478,32 @@ async def resolve_lineup_average(lineup, info):
         except KeyError:
             pass
 
-    return encode_stats(models.Stats.average(all_stats))
+    return encoding.encode_stats(models.Stats.average(all_stats))
+
+stats = ariadne.ObjectType("Stats")
+
+
+@stats.field("percentiles")
+def resolve_stats_percentiles(stats, info):
+    """
+    Resolver for how stats rank against all qualified players.
+
+    Arguments:
+        stats:      A dictionary as returned by encoding.encode_stats.
+        info:       Not used.
+    """
+    return dict(
+        (key, round(league.percentile(key, stats[key]), 1)) for key in STATS_METRICS
+    )
 
 mutation = ariadne.MutationType()
 
 
 @mutation.field("lineup")
-def resolve_mutate_lineup(obj, info, lineupId=None, **kwargs):
+async def resolve_mutate_lineup(obj, info, lineupId=None, **kwargs):
     """
-    Mutator for a lineup.
+    Mutator for a lineup. The updated lineup is published to subscribers of
+    lineupChanged.
 
     Arguments:
         lineupId:   (optional) A lineup identifier. If None, a new lineup will be
@@ -249,13 +513,46 @@ def resolve_mutate_lineup(obj, info, lineupId=None, **kwargs):
     """
     if lineupId is None:
         # Create new lineup
-        lineup = models.create_lineup(db)
+        lineup = lineup_cache.create()
         lineupId = lineup.ident
 
-    lineup = models.update_lineup(db, lineupId, **kwargs)
+    lineup, profiles, version = lineup_cache.update(lineupId, **kwargs)
+    if lineup is not None and lineup_events.has_subscribers(lineupId):
+        # Concurrent mutations may finish building their events in any order
+        event = await encode_lineup_event(info, lineup, profiles)
+        lineup_events.publish(lineupId, event, version)
+        return event
+
+    prime_lineup_profiles(info, profiles)
     return encode_lineup(lineup)
 
 
+subscription = ariadne.SubscriptionType()
+
+
+@subscription.source("lineupChanged")
+def generate_lineup_changed(obj, info, lineupId):
+    """
+    Source of lineups published when the given lineup is created or updated.
+
+    Arguments:
+        lineupId:   An integer lineup identifier created by this server.
+    """
+    return lineup_events.subscribe(lineupId)
+
+
+@subscription.field("lineupChanged")
+def resolve_lineup_changed(event, info, lineupId):
+    """
+    Resolver for a lineup published by the lineup mutation.
+
+    Arguments:
+        event:      A dictionary as returned by encode_lineup_event.
+        lineupId:   Not used.
+    """
+    return event
+
+
 async def get_stats_from_db(idents):
     """
     Helper to fetch a collection of player stats.
@@ -263,10 +560,23 @@ async def get_stats_from_db(idents):
     Arguments:
         idents: A list of string player identifiers.
     """
-    stats = models.get_stats(db, idents)
+    keys = [player_keys.key(ident) for ident in idents]
+    stats = models.get_stats_by_keys(db, keys)
     return stats
 
 
+async def get_documents_from_db(idents):
+    """
+    Helper to fetch a collection of precomputed player documents.
+
+    Arguments:
+        idents: A list of string player identifiers.
+    """
+    keys = [player_keys.key(ident) for ident in idents]
+    documents = models.get_documents(db, keys)
+    return [encoding.decode_document(document) for document in documents]
+
+
 async def get_profiles_from_db(idents):
     """
     Helper to fetch a collection of player profiles.
@@ -278,17 +588,245 @@ async def get_profiles_from_db(idents):
     return profiles
 
 
-def get_context_value(request):
+def build_league(db):
+    """
+    Helper to rank stats against all qualified players, as served by the server.
+
+    Arguments:
+        db:     An instance of databases.Database.
+    """
+    all_stats = models.get_all_stats(db, QUALIFYING_AT_BATS)
+    rows = [encoding.encode_stats(stats) for stats in all_stats]
+    return models.League(rows, STATS_METRICS)
+
+
+def get_context_value(request, data=None):
     """
     Context value getter.
+
+    A single context is shared by every operation of a batched request.
     """
     return {
         "request": request,
         "player_stats_loader": aiodataloader.DataLoader(get_stats_from_db),
         "player_profile_loader": aiodataloader.DataLoader(get_profiles_from_db),
+        "player_document_loader": aiodataloader.DataLoader(get_documents_from_db),
     }
 
 
-schema = ariadne.make_executable_schema(type_defs, [query, player, lineup, mutation])
+def is_incremental(document):
+    """
+    Returns True if the document uses the @defer or @stream directives.
+
+    Arguments:
+        document:   A graphql.DocumentNode.
+    """
+    found = False
+
+    class Visitor(graphql.Visitor):
+        def enter_directive(self, node, *args):
+            nonlocal found
+            if node.name.value in {"defer", "stream"}:
+                found = True
+                return graphql.BREAK
+
+    graphql.visit(document, Visitor())
+    return found
+
+
+class BatchGraphQLHTTPHandler(ariadne.asgi.handlers.GraphQLHTTPHandler):
+    """
+    HTTP handler which also accepts a JSON list of operations, and serializes
+    responses with responses.dumps.
+
+    Operations in a batch are executed concurrently against one shared context so
+    that data loaders deduplicate and batch across all of them. The response is a
+    list holding the result of each operation, in order.
+
+    Operations using @defer or @stream are executed against incremental_schema and
+    delivered incrementally as a multipart/mixed response if the client accepts it.
+    """
+
+    def __init__(self, incremental_schema, **kwargs):
+        super().__init__(**kwargs)
+        self.incremental_schema = incremental_schema
+
+    async def handle_request_override(self, request):
+        accept = request.headers.get("accept", "")
+        if request.method != "POST" or "multipart/mixed" not in accept:
+            return None
+
+        try:
+            data = await self.extract_data_from_request(request)
+            incremental = is_incremental(graphql.parse(data["query"]))
+        except (
+            ariadne.exceptions.HttpError,
+            graphql.GraphQLError,
+            TypeError,
+            KeyError,
+        ):
+            # Let the default handling report the error
+            return None
+
+        if not incremental:
+            return None
+
+        context_value = await self.get_context_for_request(request, data)
+        extensions = await self.get_extensions_for_request(request, context_value)
+        middleware = await self.get_middleware_for_request(request, context_value)
+        extension_manager = ariadne.ExtensionManager(extensions, context_value)
+
+        # Mirrors ariadne.graphql, executing against incremental_schema instead
+        with extension_manager.request():
+            try:
+                validate_data(data)
+                variables = data.get("variables")
+                operation_name = data.get("operationName")
+                document = parse_query(
+                    context_value, self.query_parser, data
+                )
+
+                validation_rules = self.validation_rules
+                if callable(validation_rules):
+                    validation_rules = validation_rules(context_value, document, data)
+
+                errors = validate_query(
+                    self.incremental_schema,
+                    document,
+                    validation_rules,
+                    enable_introspection=self.introspection,
+                    query_validator=self.query_validator,
+                )
+                if not errors:
+                    validate_operation_is_not_subscription(
+                        document, operation_name
+                    )
+            except graphql.GraphQLError as error:
+                errors = [error]
+
+            if errors:
+                _, result = handle_graphql_errors(
+                    errors,
+                    logger=self.logger,
+                    error_formatter=self.error_formatter,
+                    debug=self.debug,
+                    extension_manager=extension_manager,
+                )
+                return await self.create_json_response(request, result, False)
+
+            root_value = self.root_value
+            if callable(root_value):
+                root_value = root_value(
+                    context_value, operation_name, variables, document
+                )
+                if inspect.isawaitable(root_value):
+                    root_value = await root_value
+
+            result = graphql.experimental_execute_incrementally(
+                self.incremental_schema,
+                document,
+                root_value=root_value,
+                context_value=context_value,
+                variable_values=variables,
+                operation_name=operation_name,
+                middleware=extension_manager.as_middleware_manager(
+                    middleware, self.middleware_manager_class
+                ),
+            )
+            if inspect.isawaitable(result):
+                result = await result
+
+            if isinstance(result, graphql.ExecutionResult):
+                success, formatted = handle_query_result(
+                    result,
+                    logger=self.logger,
+                    error_formatter=self.error_formatter,
+                    debug=self.debug,
+                    extension_manager=extension_manager,
+                )
+                return await self.create_json_response(request, formatted, success)
+
+        return responses.MultipartResponse(
+            self.format_incremental_result(result.initial_result),
+            (
+                self.format_incremental_result(subsequent)
+                async for subsequent in result.subsequent_results
+            ),
+        )
+
+    def format_incremental_result(self, result):
+        """
+        Returns an initial or subsequent incremental result formatted for the
+        response, logging its errors and formatting them with error_formatter.
+
+        Arguments:
+            result:     A graphql.InitialIncrementalExecutionResult or
+                        graphql.SubsequentIncrementalExecutionResult.
+        """
+        formatted = result.formatted
+        if getattr(result, "errors", None):
+            formatted["errors"] = self.format_errors(result.errors)
+
+        for key in ("incremental", "completed"):
+            entries = getattr(result, key, None) or []
+            for entry, formatted_entry in zip(entries, formatted.get(key, [])):
+                if entry.errors:
+                    formatted_entry["errors"] = self.format_errors(entry.errors)
+
+        return formatted
+
+    def format_errors(self, errors):
+        """
+        Logs errors and returns them formatted with error_formatter.
+
+        Arguments:
+            errors:     A list of graphql.GraphQLError.
+        """
+        for error in errors:
+            ariadne.logger.log_error(error, self.logger)
+
+        return [self.error_formatter(error, self.debug) for error in errors]
+
+    async def execute_graphql_query(self, request, data, **kwargs):
+        if not isinstance(data, list) or not data:
+            return await super().execute_graphql_query(request, data, **kwargs)
+
+        context_value = await self.get_context_for_request(request, data)
+        results = await asyncio.gather(
+            *(
+                super(BatchGraphQLHTTPHandler, self).execute_graphql_query(
+                    request, operation, context_value=context_value
+                )
+                for operation in data
+            )
+        )
+        success = all(success for success, _ in results)
+        return success, [result for _, result in results]
+
+    async def create_json_response(self, request, result, success):
+        # Per-operation errors are reported within each result of a batch
+        if isinstance(result, list) or success or result.get("data") is not None:
+            status_code = http.HTTPStatus.OK
+        else:
+            status_code = http.HTTPStatus.BAD_REQUEST
+
+        return responses.FastJSONResponse(result, status_code=status_code)
+
+
+bindables = [query, objective, player, stats, lineup, mutation, subscription]
+schema = ariadne.make_executable_schema(type_defs, bindables)
+incremental_schema = ariadne.make_executable_schema(
+    [type_defs, incremental_type_defs], bindables
+)
+
+league = build_league(db)
+
+graphql_app = ariadne.asgi.GraphQL(
+    schema,
+    context_value=get_context_value,
+    http_handler=BatchGraphQLHTTPHandler(incremental_schema),
+    websocket_handler=ariadne.asgi.handlers.GraphQLTransportWSHandler(),
+    debug=True,
+)
 
-app = ariadne.asgi.GraphQL(schema, context_value=get_context_value, debug=True)
+app = profiling.from_environ(responses.CompressionMiddleware(graphql_app))
@@ -0,0 +1,36 @@
+"""
+Tests for the encoding module.
+"""
+import unittest
+
+from src import encoding
+from src import models
+
+
+class TestEncoding(unittest.TestCase):
+    """
+    Tests for encoding.
+    """
+
+    def test_document(self):
+        """
+        Test serializing and deserializing a player document.
+        """
+        document = encoding.encode_document(
+            models.Profile("Bob Ball", "CAN", 2001),
+            models.Stats(50, 7, 6, 8, 14 / 100, 106 / 100),
+        )
+        actual = encoding.decode_document(document)
+        expected = {
+            "profile": {"name": "Bob Ball", "country": "CAN", "year": 2001},
+            "stats": {
+                "atBats": 50,
+                "homeRuns": 7,
+                "hits": 6,
+                "strikeouts": 8,
+                "battingAverage": 0.14,
+                "sluggingPercentage": 1.06,
+            },
+        }
+        self.assertEqual(actual, expected)
+        self.assertIsNone(encoding.decode_document(None))
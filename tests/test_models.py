@@ -2,8 +2,12 @@
 Tests for the models module.
 """
 import pathlib
+import sqlite3
+import tempfile
 import unittest
+from unittest import mock
 
+from src import encoding
 from src import models
 
 from . import utils
@@ -43,6 +47,52 @@ class TestModels(unittest.TestCase):
         expected = ["3", "2"]
         self.assertEqual(actual, expected)
 
+    def test_get_player_details(self):
+        """
+        Test searching for players along with their profiles and stats.
+        """
+        actual = models.get_player_details(self._db, "B", "B")
+        expected = [
+            (
+                "3",
+                models.Profile("Bill Baker", "USA", 2002),
+                models.Stats(30, 9, 6, 12, 9 / 30, 115 / 30),
+            ),
+            (
+                "2",
+                models.Profile("Bob Ball", "CAN", 2001),
+                models.Stats(50, 7, 6, 8, 14 / 100, 106 / 100),
+            ),
+        ]
+        self.assertEqual(actual, expected)
+
+        actual = models.get_player_details(self._db, "B", "B", stats=False)
+        expected = [
+            ("3", models.Profile("Bill Baker", "USA", 2002), None),
+            ("2", models.Profile("Bob Ball", "CAN", 2001), None),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_get_player_details_without_key(self):
+        """
+        Test players added since keys were built match whether or not stats are
+        fetched.
+        """
+        self._db.insert(
+            "INSERT INTO People VALUES(?, ?, ?, ?, ?)",
+            [("5", "Bert", "Bloggs", 2003, "USA")],
+        )
+        actual = models.get_player_details(self._db, "Be", "B")
+        expected = [
+            (
+                "5",
+                models.Profile("Bert Bloggs", "USA", 2003),
+                models.Stats(*([0] * 6)),
+            )
+        ]
+        self.assertEqual(actual, expected)
+        self.assertEqual(models.get_players(self._db, "Be", "B"), ["5"])
+
     def test_get_profiles(self):
         """
         Test fetching player profiles.
@@ -65,6 +115,81 @@ class TestModels(unittest.TestCase):
         ]
         self.assertEqual(actual, expected)
 
+    def test_get_stats_by_keys(self):
+        """
+        Test fetching player stats by integer key.
+        """
+        player_keys = models.PlayerKeys.load(self._db)
+        keys = [player_keys.key("2"), 999]
+        actual = models.get_stats_by_keys(self._db, keys)
+        expected = [
+            models.Stats(50, 7, 6, 8, 14 / 100, 106 / 100),
+            models.Stats(*([0] * 6)),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_player_keys(self):
+        """
+        Test translating between player identifiers and integer keys.
+        """
+        player_keys = models.PlayerKeys.load(self._db)
+        self.assertEqual(player_keys.idents(), ["1", "2", "3", "4"])
+        self.assertEqual(player_keys.ident(player_keys.key("3")), "3")
+        self.assertIsNone(player_keys.key("bork"))
+
+        # Keys are stable when rebuilt
+        models.build_derived_tables(self._db)
+        self.assertEqual(
+            models.PlayerKeys.load(self._db).key("3"), player_keys.key("3")
+        )
+
+    def test_ensure_derived_tables(self):
+        """
+        Test rebuilding derived tables after the data is reloaded.
+        """
+        with mock.patch.object(models, "build_derived_tables") as build:
+            models.ensure_derived_tables(self._db)
+            self.assertEqual(build.call_count, 0)
+
+        self._db.insert(
+            "INSERT INTO Batting VALUES(?, ?, ?, ?, ?, ?, ?)",
+            [("1", 100, 0, 0, 0, 10, 0)],
+        )
+        models.ensure_derived_tables(self._db)
+
+        actual = models.get_stats(self._db, ["1"])[0].at_bats
+        self.assertEqual(actual, 200)
+
+        # Documents are regenerated along with the totals
+        player_keys = models.PlayerKeys.load(self._db)
+        [document] = models.get_documents(self._db, [player_keys.key("1")])
+        self.assertEqual(encoding.decode_document(document)["stats"]["atBats"], 200)
+
+    def test_get_all_stats(self):
+        """
+        Test fetching stats of qualified players.
+        """
+        actual = models.get_all_stats(self._db, min_at_bats=50)
+        expected = [
+            models.Stats(100, 10, 10, 10, 10 / 100, 91 / 100),
+            models.Stats(50, 7, 6, 8, 14 / 100, 106 / 100),
+            models.Stats(50, 7, 6, 8, 14 / 100, 102 / 100),
+        ]
+        self.assertEqual(actual, expected)
+
+    def test_league_percentile(self):
+        """
+        Test ranking values against a league.
+        """
+        rows = [{"hits": 3}, {"hits": 1}, {"hits": 2}, {"hits": 2}]
+        league = models.League(rows, ["hits"])
+        self.assertEqual(league.percentile("hits", 0), 0)
+        self.assertEqual(league.percentile("hits", 2), 75)
+        self.assertEqual(league.percentile("hits", 5), 100)
+
+        league = models.League([], ["hits"])
+        self.assertEqual(league.percentile("hits", 5), 0)
+
     def test_create_lineup(self):
         """
         Test creating a lineup.
@@ -85,6 +210,24 @@ class TestModels(unittest.TestCase):
         expected = models.Lineup(1, *([None] * 9))
         self.assertEqual(actual, expected)
 
+    def test_get_lineup_details(self):
+        """
+        Test fetching a lineup along with player profiles.
+        """
+        lineup = models.create_lineup(self._db)
+        models.assign_players(self._db, lineup.ident, pitcher="1", catcher="bork")
+        actual = models.get_lineup_details(self._db, lineup.ident)
+        expected = (
+            models.Lineup(lineup.ident, "1", *([None] * 8)),
+            {"1": models.Profile("Andy Anderson", "CAN", 2000)},
+            1,
+        )
+        self.assertEqual(actual, expected)
+
+        actual = models.get_lineup_details(self._db, 1000)
+        expected = (models.Lineup(1000, *([None] * 9)), {}, None)
+        self.assertEqual(actual, expected)
+
     def test_update_lineup(self):
         """
         Test updating a lineup.
@@ -149,3 +292,168 @@ class TestModels(unittest.TestCase):
             lineup.ident, None, "2", None, None, None, None, None, None, None
         )
         self.assertEqual(actual, expected)
+
+    def test_optimize_lineup(self):
+        """
+        Test building the best lineup from a candidate pool.
+        """
+        stats = models.get_stats(self._db, ["1", "2", "3", "4"])
+        candidates = dict(zip(["1", "2", "3", "4"], stats))
+
+        actual = models.optimize_lineup(
+            {"pitcher": "1"}, candidates, "batting_average", min_at_bats=40
+        )
+        expected = models.Lineup(
+            None, "1", "4", None, None, None, None, None, "2", None
+        )
+        self.assertEqual(actual, expected)
+
+        actual = models.optimize_lineup({}, candidates, "batting_average")
+        expected = models.Lineup(
+            None, None, "3", "2", None, None, None, "1", "4", None
+        )
+        self.assertEqual(actual, expected)
+
+
+class TestLineupCache(unittest.TestCase):
+    """
+    Tests for the lineup cache.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = pathlib.Path(self._dir.name) / "test.sqlite"
+        self._db = models.get_db(self._path)
+        utils.init_db(self._db)
+
+    def tearDown(self):
+        self._db.close()
+        self._dir.cleanup()
+
+    def test_write_through(self):
+        """
+        Test lineups written through the cache are served without reading them.
+        """
+        cache = models.LineupCache(self._db)
+        lineup = cache.create()
+        cache.update(lineup.ident, pitcher="1")
+
+        with mock.patch.object(
+            models, "get_lineup_details", side_effect=AssertionError
+        ):
+            actual = cache.get(lineup.ident)
+
+        expected = (
+            models.Lineup(lineup.ident, "1", *([None] * 8)),
+            {"1": models.Profile("Andy Anderson", "CAN", 2000)},
+        )
+        self.assertEqual(actual, expected)
+
+    def test_update_without_reading(self):
+        """
+        Test cached lineups are updated in memory.
+        """
+        cache = models.LineupCache(self._db)
+        lineup = cache.create()
+
+        updates = [
+            {"pitcher": "1", "catcher": "Bob Ball", "firstBase": "bork"},
+            # Moving a player clears their previous position
+            {"catcher": "Andy Anderson", "shortstop": "3"},
+            {"shortstop": None},
+        ]
+        for kwargs in updates:
+            with mock.patch.object(
+                models, "get_lineup_details", side_effect=AssertionError
+            ):
+                actual = cache.update(lineup.ident, **kwargs)
+
+            expected = models.get_lineup_details(self._db, lineup.ident)
+            self.assertEqual(actual, expected)
+
+        expected = models.Lineup(lineup.ident, None, "1", *([None] * 7))
+        self.assertEqual(actual[0], expected)
+
+    def test_warm_and_evict(self):
+        """
+        Test warming up and bounding the cache.
+        """
+        for _ in range(3):
+            models.create_lineup(self._db)
+
+        cache = models.LineupCache(self._db, maxsize=2)
+        cache.warm()
+
+        with mock.patch.object(
+            models, "get_lineup_details", wraps=models.get_lineup_details
+        ) as reads:
+            cache.get(2)
+            cache.get(3)
+            self.assertEqual(reads.call_count, 0)
+
+            # Evicts the least recently used lineup
+            cache.get(1)
+            cache.get(3)
+            self.assertEqual(reads.call_count, 1)
+            cache.get(2)
+            self.assertEqual(reads.call_count, 2)
+
+    def test_stale(self):
+        """
+        Test detecting lineups updated by another connection.
+        """
+        cache = models.LineupCache(self._db)
+        lineup = cache.create()
+        cache.update(lineup.ident, pitcher="1")
+
+        other = models.get_db(self._path)
+        try:
+            models.update_lineup(other, lineup.ident, pitcher="2")
+        finally:
+            other.close()
+
+        actual, _ = cache.get(lineup.ident)
+        expected = models.Lineup(lineup.ident, "2", *([None] * 8))
+        self.assertEqual(actual, expected)
+
+
+class TestMigrations(unittest.TestCase):
+    """
+    Tests for migrating existing databases.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = pathlib.Path(self._dir.name) / "test.sqlite"
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_migrate_assignments(self):
+        """
+        Test lineup assignments keyed by string identifiers are migrated.
+        """
+        conn = sqlite3.connect(self._path)
+        conn.executescript(
+            """
+            CREATE TABLE People (playerID TEXT UNIQUE, nameFirst TEXT,
+                nameLast TEXT, birthYear INTEGER, birthCountry TEXT);
+            INSERT INTO People VALUES ("b", "Bob", "Ball", 2001, "CAN");
+            INSERT INTO People VALUES ("a", "Andy", "Anderson", 2000, "CAN");
+            CREATE TABLE Lineups (lineupId INTEGER PRIMARY KEY AUTOINCREMENT);
+            INSERT INTO Lineups DEFAULT VALUES;
+            CREATE TABLE LineupAssignments (lineupId INTEGER, position TEXT,
+                playerId TEXT);
+            INSERT INTO LineupAssignments VALUES (1, "pitcher", "b");
+            """
+        )
+        conn.commit()
+        conn.close()
+
+        db = models.get_db(self._path)
+        try:
+            actual = models.get_lineup(db, 1)
+            self.assertEqual(actual, models.Lineup(1, "b", *([None] * 8)))
+            self.assertNotIn("playerId", models.get_columns(db, "LineupAssignments"))
+        finally:
+            db.close()
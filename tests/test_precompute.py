@@ -0,0 +1,46 @@
+"""
+Tests for the precompute module.
+"""
+import unittest
+
+from src import encoding
+from src import models
+from src import precompute
+
+from . import utils
+
+
+class TestPrecompute(unittest.TestCase):
+    """
+    Tests for precompute.
+    """
+
+    def setUp(self):
+        self._db = models.get_db(":memory:")
+        utils.init_db(self._db)
+
+    def tearDown(self):
+        self._db.close()
+
+    def test_precompute(self):
+        """
+        Test writing a document for every player.
+        """
+        precompute.precompute(self._db)
+        player_keys = models.PlayerKeys.load(self._db)
+
+        actual = models.get_documents(self._db, [player_keys.key("2"), 999])
+        expected = [
+            encoding.encode_document(
+                models.Profile("Bob Ball", "CAN", 2001),
+                models.Stats(50, 7, 6, 8, 14 / 100, 106 / 100),
+            ),
+            None,
+        ]
+        self.assertEqual(actual, expected)
+
+        # Documents are replaced when regenerated
+        precompute.precompute(self._db)
+        keys = [player_keys.key(ident) for ident in ["1", "2", "3", "4"]]
+        actual = models.get_documents(self._db, keys)
+        self.assertNotIn(None, actual)
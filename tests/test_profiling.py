@@ -0,0 +1,109 @@
+"""
+Tests for the profiling module.
+"""
+import asyncio
+import pathlib
+import tempfile
+import time
+import unittest
+
+from src import profiling
+
+
+async def slow_app(scope, receive, send):
+    """
+    An ASGI application which keeps the event loop busy.
+    """
+    end = time.perf_counter() + 0.05
+    while time.perf_counter() < end:
+        pass
+
+
+def busy(seconds):
+    """
+    Keeps the event loop busy.
+    """
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+async def spawned_work():
+    """
+    Work done in a task spawned by a request.
+    """
+    for _ in range(3):
+        busy(0.01)
+        await asyncio.sleep(0)
+
+
+async def interleaved_app(scope, receive, send):
+    """
+    An ASGI application which yields to other requests and spawns a task.
+    """
+    for _ in range(3):
+        busy(0.01)
+        await asyncio.sleep(0)
+
+    await asyncio.create_task(spawned_work())
+
+
+async def other_app(scope, receive, send):
+    """
+    An ASGI application handling a concurrent request.
+    """
+    for _ in range(6):
+        busy(0.01)
+        await asyncio.sleep(0)
+
+
+class TestProfiling(unittest.IsolatedAsyncioTestCase):
+    """
+    Tests for profiling.
+    """
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self._app = profiling.ProfilingMiddleware(slow_app, self._dir.name, "secret")
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    async def test_profile_with_token(self):
+        scope = {"type": "http", "headers": [(b"x-profile", b"secret")]}
+        await self._app(scope, None, None)
+
+        paths = sorted(pathlib.Path(self._dir.name).iterdir())
+        self.assertEqual([p.suffix for p in paths], [".folded", ".txt"])
+
+        # Lines are like "outer (file:1);inner (file:2) 12"
+        lines = paths[0].read_text().splitlines()
+        self.assertTrue(any("slow_app" in line for line in lines))
+        for line in lines:
+            _, count = line.rsplit(" ", maxsplit=1)
+            self.assertGreater(int(count), 0)
+
+    async def test_no_profile(self):
+        for headers in [[], [(b"x-profile", b"bork")]]:
+            await self._app({"type": "http", "headers": headers}, None, None)
+
+        self.assertEqual(list(pathlib.Path(self._dir.name).iterdir()), [])
+
+    async def test_concurrent_requests(self):
+        """
+        Test only the profiled request and the tasks it spawns are sampled.
+        """
+        profiled = profiling.ProfilingMiddleware(
+            interleaved_app, self._dir.name, "secret"
+        )
+        scope = {"type": "http", "headers": [(b"x-profile", b"secret")]}
+        await asyncio.gather(
+            profiled(scope, None, None),
+            other_app({"type": "http", "headers": []}, None, None),
+        )
+
+        [path] = pathlib.Path(self._dir.name).glob("*.folded")
+        text = path.read_text()
+        self.assertIn("interleaved_app", text)
+        self.assertIn("spawned_work", text)
+        self.assertNotIn("other_app", text)
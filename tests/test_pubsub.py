@@ -0,0 +1,70 @@
+"""
+Tests for the pubsub module.
+"""
+import unittest
+
+from src import pubsub
+
+
+class TestBroker(unittest.IsolatedAsyncioTestCase):
+    """
+    Tests for Broker.
+    """
+
+    async def test_publish(self):
+        """
+        Test sending an event to every subscriber of its topic.
+        """
+        broker = pubsub.Broker()
+        first = broker.subscribe(1)
+        second = broker.subscribe(1)
+        other = broker.subscribe(2)
+
+        event = {"lineupId": 1}
+        broker.publish(1, event)
+
+        self.assertIs(await anext(first), event)
+        self.assertIs(await anext(second), event)
+        self.assertTrue(other._queue.empty())
+
+    async def test_drop_oldest(self):
+        """
+        Test slow subscribers receive the newest events.
+        """
+        broker = pubsub.Broker(maxsize=2)
+        subscription = broker.subscribe(1)
+        for event in range(5):
+            broker.publish(1, event)
+
+        self.assertEqual(subscription.dropped, 3)
+        self.assertEqual(await anext(subscription), 3)
+        self.assertEqual(await anext(subscription), 4)
+
+    async def test_versions(self):
+        """
+        Test events older than the last one published are dropped.
+        """
+        broker = pubsub.Broker()
+        subscription = broker.subscribe(1)
+        broker.publish(1, "second", 2)
+        broker.publish(1, "first", 1)
+        broker.publish(1, "third", 3)
+
+        self.assertEqual(await anext(subscription), "second")
+        self.assertEqual(await anext(subscription), "third")
+        self.assertTrue(subscription._queue.empty())
+
+    async def test_unsubscribe(self):
+        """
+        Test closed subscriptions stop receiving events.
+        """
+        broker = pubsub.Broker()
+        subscription = broker.subscribe(1)
+        self.assertTrue(broker.has_subscribers(1))
+
+        await subscription.aclose()
+        self.assertFalse(broker.has_subscribers(1))
+
+        broker.publish(1, "event")
+        with self.assertRaises(StopAsyncIteration):
+            await anext(subscription)
@@ -0,0 +1,74 @@
+"""
+Tests for the responses module.
+"""
+import gzip
+import json
+import unittest
+from unittest import mock
+
+from src import responses
+
+
+def make_app(body, more_body=False):
+    """
+    Returns an ASGI application sending the given body.
+    """
+
+    async def app(scope, receive, send):
+        headers = [(b"content-type", b"application/json")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    return app
+
+
+class TestResponses(unittest.IsolatedAsyncioTestCase):
+    """
+    Tests for responses.
+    """
+
+    async def request(self, app, accept_encoding):
+        scope = {
+            "type": "http",
+            "headers": [(b"accept-encoding", accept_encoding.encode())],
+        }
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await responses.CompressionMiddleware(app, minimum_size=100)(scope, None, send)
+        start, *bodies = messages
+        return dict(start["headers"]), bodies
+
+    def test_dumps(self):
+        content = {"name": "Bob Ball", "average": 0.14, "players": [1, 2]}
+        expected = b'{"name":"Bob Ball","average":0.14,"players":[1,2]}'
+        self.assertEqual(responses.dumps(content), expected)
+
+        with mock.patch.object(responses, "orjson", None):
+            self.assertEqual(responses.dumps(content), expected)
+
+    def test_parse_accept_encoding(self):
+        actual = responses.parse_accept_encoding("gzip;q=0.5, br;q=0, Identity")
+        self.assertEqual(actual, {"gzip", "identity"})
+
+    async def test_compress(self):
+        body = json.dumps([{"playerId": str(i)} for i in range(100)]).encode()
+
+        with mock.patch.object(responses, "brotli", None):
+            headers, bodies = await self.request(make_app(body), "br, gzip")
+        self.assertEqual(headers[b"content-encoding"], b"gzip")
+        self.assertEqual(headers[b"vary"], b"Accept-Encoding")
+        self.assertEqual(gzip.decompress(bodies[0]["body"]), body)
+
+    async def test_no_compress(self):
+        body = json.dumps([{"playerId": str(i)} for i in range(100)]).encode()
+        cases = [
+            (make_app(body), "identity"),
+            (make_app(b"[]"), "gzip"),
+            (make_app(body, more_body=True), "gzip"),
+        ]
+        for app, accept_encoding in cases:
+            headers, _ = await self.request(app, accept_encoding)
+            self.assertNotIn(b"content-encoding", headers)
@@ -1,10 +1,18 @@
 """
 Tests for the server module.
 """
+import asyncio
+import json
 import pathlib
 import unittest
+from unittest import mock
 
+import ariadne
+import starlette.requests
+
+from src import encoding
 from src import models
+from src import pubsub
 from src import server
 
 from . import utils
@@ -19,6 +27,30 @@ class MockInfo:
         return server.get_context_value(None)
 
 
+def make_request(data, accept):
+    """
+    Creates a POST request with a JSON body.
+    """
+    body = json.dumps(data).encode()
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    headers = [(b"content-type", b"application/json"), (b"accept", accept.encode())]
+    scope = {"type": "http", "method": "POST", "headers": headers, "path": "/"}
+    return starlette.requests.Request(scope, receive)
+
+
+async def read_multipart(response):
+    """
+    Returns the JSON parts of a multipart/mixed response.
+    """
+    body = b"".join([part async for part in response.body_iterator])
+    assert body.endswith(b"\r\n-----\r\n")
+    parts = body[: -len(b"\r\n-----\r\n")].split(b"\r\n---\r\n")[1:]
+    return [json.loads(part.split(b"\r\n\r\n")[1]) for part in parts]
+
+
 class TestServer(unittest.IsolatedAsyncioTestCase):
     """
     Tests for server.
@@ -31,8 +63,20 @@ class TestServer(unittest.IsolatedAsyncioTestCase):
         self._server_db = server.db
         server.db = self._db
 
+        self._server_lineup_cache = server.lineup_cache
+        server.lineup_cache = models.LineupCache(self._db)
+
+        self._server_player_keys = server.player_keys
+        server.player_keys = models.PlayerKeys.load(self._db)
+
+        self._server_lineup_events = server.lineup_events
+        server.lineup_events = pubsub.Broker()
+
     async def asyncTearDown(self):
         server.db = self._server_db
+        server.lineup_cache = self._server_lineup_cache
+        server.player_keys = self._server_player_keys
+        server.lineup_events = self._server_lineup_events
         self._db.close()
 
     def test_resolve_player(self):
@@ -45,6 +89,99 @@ class TestServer(unittest.IsolatedAsyncioTestCase):
         expected = [{"playerId": "3"}, {"playerId": "2"}]
         self.assertEqual(actual, expected)
 
+    async def test_resolve_players_prefetch(self):
+        query = """
+            fragment PlayerParts on Player {
+                profile { name }
+            }
+            {
+                players(firstName: "B", lastName: "B") {
+                    ...PlayerParts
+                    stats { atBats }
+                }
+            }
+        """
+        # Profiles and stats must come from the single prefetch query
+        with (
+            mock.patch.object(models, "get_profiles", side_effect=AssertionError),
+            mock.patch.object(models, "get_stats_by_keys", side_effect=AssertionError),
+            mock.patch.object(models, "get_documents", side_effect=AssertionError),
+        ):
+            _, actual = await ariadne.graphql(
+                server.schema,
+                {"query": query},
+                context_value=server.get_context_value(None),
+            )
+        expected = {
+            "data": {
+                "players": [
+                    {"profile": {"name": "Bill Baker"}, "stats": {"atBats": 30}},
+                    {"profile": {"name": "Bob Ball"}, "stats": {"atBats": 50}},
+                ]
+            }
+        }
+        self.assertEqual(actual, expected)
+
+    async def test_resolve_lineup_prefetch(self):
+        lineup = server.lineup_cache.create()
+        server.lineup_cache.update(lineup.ident, pitcher="1")
+
+        # Without documents profiles are resolved by the profile loader
+        models.set_documents(self._db, [])
+        queries = [
+            """
+            query ($lineupId: Int!) {
+                lineup(lineupId: $lineupId) { pitcher { profile { name } } }
+            }
+            """,
+            """
+            mutation ($lineupId: Int) {
+                lineup(lineupId: $lineupId, catcher: "2") {
+                    pitcher { profile { name } }
+                }
+            }
+            """,
+        ]
+        for query in queries:
+            data = {"query": query, "variables": {"lineupId": lineup.ident}}
+
+            # Profiles must come from the lineup read
+            with mock.patch.object(models, "get_profiles", side_effect=AssertionError):
+                _, actual = await ariadne.graphql(
+                    server.schema, data, context_value=server.get_context_value(None)
+                )
+            expected = {"lineup": {"pitcher": {"profile": {"name": "Andy Anderson"}}}}
+            self.assertEqual(actual, {"data": expected})
+
+    async def test_resolve_lineup_documents(self):
+        lineup = server.lineup_cache.create()
+        server.lineup_cache.update(lineup.ident, pitcher="1")
+        query = """
+            query ($lineupId: Int!) {
+                lineup(lineupId: $lineupId) {
+                    pitcher { profile { name } stats { atBats } }
+                }
+            }
+        """
+        data = {"query": query, "variables": {"lineupId": lineup.ident}}
+
+        # Stats must come from the precomputed document
+        with mock.patch.object(
+            models, "get_stats_by_keys", side_effect=AssertionError
+        ):
+            _, actual = await ariadne.graphql(
+                server.schema, data, context_value=server.get_context_value(None)
+            )
+        expected = {
+            "lineup": {
+                "pitcher": {
+                    "profile": {"name": "Andy Anderson"},
+                    "stats": {"atBats": 100},
+                }
+            }
+        }
+        self.assertEqual(actual, {"data": expected})
+
     async def test_resolve_stats(self):
         actual = await server.resolve_player_stats({"playerId": "1"}, MockInfo())
         expected = {
@@ -61,3 +198,222 @@ class TestServer(unittest.IsolatedAsyncioTestCase):
         actual = await server.resolve_player_profile({"playerId": "1"}, MockInfo())
         expected = {"name": "Andy Anderson", "country": "CAN", "year": 2000}
         self.assertEqual(actual, expected)
+
+    async def test_resolve_optimize_lineup(self):
+        actual = await server.resolve_optimize_lineup(
+            None,
+            MockInfo(),
+            ["1", "2", "3"],
+            "slugging_percentage",
+            lockedPositions={"pitcher": "4", "catcher": None},
+        )
+        self.assertEqual(actual["lineupId"], None)
+        self.assertEqual(actual["pitcher"], {"playerId": "4"})
+        self.assertEqual(len(actual), 5)
+
+    async def test_optimize_lineup_null_min_at_bats(self):
+        query = """
+            {
+                optimizeLineup(
+                    candidatePool: ["1", "2"], objective: battingAverage,
+                    minAtBats: null
+                ) { catcher { playerId } centerField { playerId } }
+            }
+        """
+        success, result = await ariadne.graphql(
+            server.schema,
+            {"query": query},
+            context_value=server.get_context_value(None),
+        )
+        self.assertTrue(success)
+        self.assertNotIn("errors", result)
+        players = result["data"]["optimizeLineup"].values()
+        self.assertEqual({player["playerId"] for player in players}, {"1", "2"})
+
+    async def test_batched_operations(self):
+        handler = server.graphql_app.http_handler
+        operations = [
+            {"query": '{ player(playerId: "1") { stats { atBats } } }'},
+            {"query": '{ player(playerId: "1") { stats { hits } } }'},
+            {"query": "{ bork }"},
+        ]
+        with mock.patch.object(
+            models, "get_documents", wraps=models.get_documents
+        ) as get_documents:
+            success, actual = await handler.execute_graphql_query(None, operations)
+
+        # Operations share one loader so players are fetched in a single batch
+        self.assertEqual(get_documents.call_count, 1)
+        self.assertFalse(success)
+        self.assertEqual(actual[0], {"data": {"player": {"stats": {"atBats": 100}}}})
+        self.assertEqual(actual[1], {"data": {"player": {"stats": {"hits": 10}}}})
+        self.assertIn("errors", actual[2])
+
+    async def test_resolve_profile_document(self):
+        document = encoding.encode_document(
+            models.Profile("Zed Zulu", "USA", 1999), models.Stats(*([0] * 6))
+        )
+        models.set_documents(self._db, [(server.player_keys.key("1"), document)])
+
+        actual = await server.resolve_player_profile({"playerId": "1"}, MockInfo())
+        expected = {"name": "Zed Zulu", "country": "USA", "year": 1999}
+        self.assertEqual(actual, expected)
+
+    async def test_resolve_stats_percentiles(self):
+        all_stats = models.get_all_stats(self._db, 50)
+        rows = [encoding.encode_stats(stats) for stats in all_stats]
+        league = models.League(rows, server.STATS_METRICS)
+
+        stats = await server.resolve_player_stats({"playerId": "2"}, MockInfo())
+        with mock.patch.object(server, "league", league):
+            actual = server.resolve_stats_percentiles(stats, None)
+        expected = {
+            "atBats": 66.7,
+            "homeRuns": 66.7,
+            "hits": 66.7,
+            "strikeouts": 66.7,
+            "battingAverage": 100.0,
+            "sluggingPercentage": 100.0,
+        }
+        self.assertEqual(actual, expected)
+
+    async def test_incremental_delivery(self):
+        handler = server.graphql_app.http_handler
+        query = """
+            {
+                players(firstName: "B", lastName: "B") @stream(initialCount: 1) {
+                    profile { name }
+                    ... @defer { stats { atBats } }
+                }
+            }
+        """
+        request = make_request({"query": query}, "multipart/mixed")
+        response = await handler.handle_request_override(request)
+        self.assertEqual(response.media_type, 'multipart/mixed; boundary="-"')
+
+        results = await read_multipart(response)
+
+        expected = {"players": [{"profile": {"name": "Bill Baker"}}]}
+        self.assertEqual(results[0]["data"], expected)
+        self.assertFalse(results[-1]["hasNext"])
+
+        # Without multipart support operations go through the default handling
+        request = make_request({"query": query}, "application/json")
+        self.assertIsNone(await handler.handle_request_override(request))
+
+    async def test_incremental_delivery_errors(self):
+        handler = server.graphql_app.http_handler
+        query = '{ player(playerId: "1") { ... @defer { stats { atBats } } } }'
+        request = make_request({"query": query}, "multipart/mixed")
+        with (
+            mock.patch.object(
+                models, "get_documents", side_effect=RuntimeError("bork")
+            ),
+            self.assertLogs("ariadne", "ERROR"),
+        ):
+            response = await handler.handle_request_override(request)
+            results = await read_multipart(response)
+
+        # Errors in later payloads are formatted like any other error
+        [error] = results[1]["completed"][0]["errors"]
+        self.assertEqual(error["message"], "bork")
+        self.assertIn("exception", error["extensions"])
+
+        # Operations are validated like any other operation
+        data = {"query": query, "variables": "bork"}
+        response = await handler.handle_request_override(
+            make_request(data, "multipart/mixed")
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("errors", json.loads(response.body))
+
+    async def test_lineup_changed(self):
+        lineup = server.lineup_cache.create()
+        query = """
+            subscription ($lineupId: Int!) {
+                lineupChanged(lineupId: $lineupId) {
+                    lineupId
+                    average { atBats }
+                    pitcher { profile { name } stats { atBats } }
+                }
+            }
+        """
+        data = {"query": query, "variables": {"lineupId": lineup.ident}}
+        subscriptions = []
+        for _ in range(2):
+            success, results = await ariadne.subscribe(
+                server.schema, data, context_value=server.get_context_value(None)
+            )
+            self.assertTrue(success)
+            subscriptions.append(results)
+
+        mutation = {
+            "query": "mutation ($lineupId: Int) { lineup(lineupId: $lineupId, "
+            'pitcher: "1", catcher: "2") { lineupId } }',
+            "variables": {"lineupId": lineup.ident},
+        }
+        with mock.patch.object(
+            server, "encode_lineup_event", wraps=server.encode_lineup_event
+        ) as encode:
+            success, _ = await ariadne.graphql(
+                server.schema, mutation, context_value=server.get_context_value(None)
+            )
+            self.assertTrue(success)
+
+        # The event is built once for all subscribers
+        self.assertEqual(encode.call_count, 1)
+
+        expected = {
+            "lineupChanged": {
+                "lineupId": lineup.ident,
+                "average": {"atBats": 75},
+                "pitcher": {
+                    "profile": {"name": "Andy Anderson"},
+                    "stats": {"atBats": 100},
+                },
+            }
+        }
+        for results in subscriptions:
+            result = await anext(results)
+            self.assertEqual(result.data, expected)
+            await results.aclose()
+
+        self.assertFalse(server.lineup_events.has_subscribers(lineup.ident))
+
+    async def test_lineup_changed_concurrent(self):
+        lineup = server.lineup_cache.create()
+        subscription = server.lineup_events.subscribe(lineup.ident)
+
+        mutation = (
+            "mutation ($lineupId: Int, $pitcher: String) { "
+            "lineup(lineupId: $lineupId, pitcher: $pitcher) { lineupId } }"
+        )
+
+        # The second mutation builds its event first since its stats are loaded
+        context = server.get_context_value(None)
+        await context["player_stats_loader"].load("2")
+        await asyncio.gather(
+            *(
+                ariadne.graphql(
+                    server.schema,
+                    {
+                        "query": mutation,
+                        "variables": {"lineupId": lineup.ident, "pitcher": pitcher},
+                    },
+                    context_value=context_value,
+                )
+                for pitcher, context_value in [
+                    ("1", server.get_context_value(None)),
+                    ("2", context),
+                ]
+            )
+        )
+
+        # Only the latest lineup is sent
+        event = await anext(subscription)
+        self.assertEqual(event["pitcher"]["playerId"], "2")
+        self.assertTrue(subscription._queue.empty())
+
+        actual, _ = server.lineup_cache.get(lineup.ident)
+        self.assertEqual(actual.pitcher, "2")
+        await subscription.aclose()
@@ -1,3 +1,6 @@
+from src import models
+
+
 def init_db(db):
     data = [
         ("1", "Andy", "Anderson", 2000, "CAN"),
@@ -19,3 +22,5 @@ def init_db(db):
     ]
 
     db.insert("INSERT INTO 'Batting' VALUES(?, ?, ?, ?, ?, ?, ?)", data)
+
+    models.build_derived_tables(db)